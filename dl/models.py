@@ -2,7 +2,9 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint_sequential
 from dataclasses import dataclass
+import functools
 import numpy as np
 import math 
 
@@ -17,6 +19,7 @@ class Config:
     dropout: int 
     bias: bool = True
     device: str = 'cpu'
+    gradient_checkpointing: bool = False
 
 
 # Karpathy
@@ -33,22 +36,60 @@ class BigramLanguageModel(nn.Module):
         return logits
 
 
+def forward_blocks(blocks, x, use_cache=False, input_pos=None, gradient_checkpointing=False):
+    """
+    Runs x through the transformer blocks. With gradient_checkpointing, the activations
+    of the blocks are recomputed in the backward pass while training instead of being
+    stored, which trades compute for memory.
+    """
+    if use_cache or input_pos is not None:
+        for block in blocks:
+            x = block(x, use_cache, input_pos)
+        return x
+    if gradient_checkpointing and blocks.training and torch.is_grad_enabled():
+        return checkpoint_sequential(blocks, min(len(blocks), 4), x, use_reentrant=False)
+    for block in blocks:
+        x = block(x)
+    return x
+
+
+def init_embeddings(model, std=0.02):
+    """
+    Initializes the token and position embeddings of model with N(0, std), like nanoGPT.
+    The token embedding is shared with lm_head, with the N(0, 1) init of nn.Embedding
+    the initial logits would be far too large and the positions would dominate the tokens.
+    """
+    nn.init.normal_(model.token_embedding_table.weight, std=std)
+    nn.init.normal_(model.position_embedding_table.weight, std=std)
+
+
 class simpleGPT(nn.Module):
-    def __init__(self, vocab_size, n_embd, num_heads, block_size, n_layer, dropout, device):
+    def __init__(self, vocab_size, n_embd, num_heads, block_size, n_layer, dropout, device, gradient_checkpointing=False):
         super().__init__()
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd, n_head=num_heads, block_size=block_size, dropout=dropout) for _ in range(n_layer)])
+        self.blocks = nn.ModuleList([Block(n_embd, n_head=num_heads, block_size=block_size, dropout=dropout) for _ in range(n_layer)])
         self.ln_f = nn.LayerNorm(n_embd)
         self.lm_head = nn.Linear(n_embd, vocab_size)
+        # weight tying, nn.Linear stores its weight as (vocab_size, n_embd) like the embedding
+        self.lm_head.weight = self.token_embedding_table.weight
+        init_embeddings(self)
         self.device = device
+        self.gradient_checkpointing = gradient_checkpointing
+        # the KV caches of the attention layers, set by allocate_kv_cache
+        self.kv_cache = None
+        self.register_buffer('pos_ids', torch.arange(block_size), persistent=False)
 
-    def forward(self, idx):
+    def forward(self, idx, use_cache=False, input_pos=None):
         B, T = idx.shape
-        tok_emb = self.token_embedding_table(idx) 
-        positinal_emb = self.position_embedding_table(torch.arange(T, device=self.device))
-        x = tok_emb + positinal_emb
-        x = self.blocks(x)
+        if input_pos is None:
+            past_length = self.kv_cache[0].length if use_cache else 0
+            positions = self.pos_ids[past_length:past_length+T]
+        else:
+            positions = input_pos
+        x = self.token_embedding_table(idx) 
+        x.add_(self.position_embedding_table(positions))
+        x = forward_blocks(self.blocks, x, use_cache, input_pos, self.gradient_checkpointing)
         logits = self.lm_head(x)
         return logits
     
@@ -58,16 +99,27 @@ class GPT1(nn.Module):
         super().__init__()
         self.token_embedding_table = nn.Embedding(config.vocab_size, config.dim_embeddings)
         self.position_embedding_table = nn.Embedding(config.dim_context, config.dim_embeddings)
-        self.blocks = nn.Sequential(*[BlockGPT1(config.dim_embeddings, config.num_heads, config.dim_context, config.dropout) for _ in range(config.n_layer)])
+        self.blocks = nn.ModuleList([BlockGPT1(config.dim_embeddings, config.num_heads, config.dim_context, config.dropout) for _ in range(config.n_layer)])
         self.lm_head = nn.Linear(config.dim_embeddings, config.vocab_size)
+        # weight tying
+        self.lm_head.weight = self.token_embedding_table.weight
+        init_embeddings(self)
         self.device = config.device
+        self.gradient_checkpointing = config.gradient_checkpointing
+        # the KV caches of the attention layers, set by allocate_kv_cache
+        self.kv_cache = None
+        self.register_buffer('pos_ids', torch.arange(config.dim_context), persistent=False)
 
-    def forward(self, idx):
+    def forward(self, idx, use_cache=False, input_pos=None):
         T = idx.shape[-1]
-        embedding_token = self.token_embedding_table(idx) 
-        embedding_position = self.position_embedding_table(torch.arange(T, device=self.device))
-        x = embedding_token + embedding_position 
-        x = self.blocks(x)
+        if input_pos is None:
+            past_length = self.kv_cache[0].length if use_cache else 0
+            positions = self.pos_ids[past_length:past_length+T]
+        else:
+            positions = input_pos
+        x = self.token_embedding_table(idx) 
+        x.add_(self.position_embedding_table(positions))
+        x = forward_blocks(self.blocks, x, use_cache, input_pos, self.gradient_checkpointing)
         logits = self.lm_head(x)
         return logits
     
@@ -78,16 +130,28 @@ class GPT2(nn.Module):
         self.token_embedding_table = nn.Embedding(config.vocab_size, config.dim_embeddings)
         self.position_embedding_table = nn.Embedding(config.dim_context, config.dim_embeddings)
         self.drop = nn.Dropout(config.dropout)
-        self.blocks = nn.Sequential(*[BlockGPT2(config.dim_embeddings, config.num_heads, config.dim_context, config.bias, config.dropout) for _ in range(config.n_layer)])
+        self.blocks = nn.ModuleList([BlockGPT2(config.dim_embeddings, config.num_heads, config.dim_context, config.bias, config.dropout) for _ in range(config.n_layer)])
         self.lm_head = nn.Linear(config.dim_embeddings, config.vocab_size)
+        # weight tying
+        self.lm_head.weight = self.token_embedding_table.weight
+        init_embeddings(self)
         self.device = config.device
+        self.gradient_checkpointing = config.gradient_checkpointing
+        # the KV caches of the attention layers, set by allocate_kv_cache
+        self.kv_cache = None
+        self.register_buffer('pos_ids', torch.arange(config.dim_context), persistent=False)
 
-    def forward(self, idx):
+    def forward(self, idx, use_cache=False, input_pos=None):
         T = idx.shape[-1]
-        embedding_token = self.token_embedding_table(idx) 
-        embedding_position = self.position_embedding_table(torch.arange(T, device=self.device))
-        x = self.drop(embedding_token + embedding_position)
-        x = self.blocks(x)
+        if input_pos is None:
+            past_length = self.kv_cache[0].length if use_cache else 0
+            positions = self.pos_ids[past_length:past_length+T]
+        else:
+            positions = input_pos
+        x = self.token_embedding_table(idx) 
+        x.add_(self.position_embedding_table(positions))
+        x = self.drop(x)
+        x = forward_blocks(self.blocks, x, use_cache, input_pos, self.gradient_checkpointing)
         logits = self.lm_head(x)
         return logits
 
@@ -109,7 +173,7 @@ class FeedFowardGPT2(nn.Module):
         super().__init__()
         self.net = nn.Sequential(
             nn.Linear(n_embd, 4 * n_embd),
-            nn.GELU(),
+            nn.GELU(approximate='tanh'),
             nn.Linear(4 * n_embd, n_embd),
             nn.Dropout(dropout),
         )
@@ -133,43 +197,131 @@ class FeedFoward(nn.Module):
 
 
 class Head(nn.Module):
-    """ one head of self-attention """
+    """
+    one head of self-attention
+    Reference implementation, MultiHeadAttention computes all heads at once
+    with a single fused qkv projection.
+    """
 
     def __init__(self, head_size, n_embd, block_size, dropout=0.0):
         super().__init__()
         self.key = nn.Linear(n_embd, head_size, bias=False)
         self.query = nn.Linear(n_embd, head_size, bias=False)
         self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
+        # additive causal mask, -inf above the diagonal and 0 elsewhere
+        self.register_buffer('mask', torch.full((block_size, block_size), float('-inf')).triu_(1))
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
         T = x.shape[-2]
         k = self.key(x)   
         q = self.query(x) 
-        wei = q @ k.transpose(-2,-1) * k.shape[-1]**-0.5 
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf'))
+        v = self.value(x) 
+        head_size = k.shape[-1]
+        # flatten the leading dimensions to (N, T, hs), so that baddbmm can fuse
+        # the scaling and the mask into the accumulator of the batched GEMM
+        q, k, v = [t.reshape(-1, T, head_size) for t in (q, k, v)]
+        wei = torch.baddbmm(self.mask[:T, :T], q, k.transpose(-2,-1), beta=1.0, alpha=head_size**-0.5)
         wei = F.softmax(wei, dim=-1) 
         wei = self.dropout(wei)
-        v = self.value(x) 
         out = wei @ v 
-        return out
+        return out.view(*x.shape[:-1], head_size)
     
 
+class KVCache(nn.Module):
+    """
+    Keys and values of the already processed tokens of one attention layer.
+    Used by generate, so that every step only computes the projections of the new tokens.
+    buffer has shape (2, ..., nH, max_T, hs) and is usually a view into the single
+    tensor of all layers created by allocate_kv_cache, so no memory is allocated per step.
+    The buffer is registered as non persistent buffer of the attention layer, so that
+    torch.compile treats it as state of the model instead of as argument of the step.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self.register_buffer('buffer', buffer, persistent=False)
+        self.length = 0
+
+    def update(self, k, v):
+        """
+        Writes the keys and values of the new tokens into the buffer and returns the ones of all tokens.
+        """
+        T = k.shape[-2]
+        self.buffer[0, ..., self.length:self.length+T, :] = k
+        self.buffer[1, ..., self.length:self.length+T, :] = v
+        self.length += T
+        return self.buffer[0, ..., :self.length, :], self.buffer[1, ..., :self.length, :]
+
+    def write(self, k, v, input_pos):
+        """
+        Writes the keys and values of the new tokens at the positions input_pos and returns
+        the whole buffer, so that the shapes do not depend on the number of processed tokens.
+        The length is not tracked, the caller keeps track of the positions.
+        """
+        self.buffer[0].index_copy_(-2, input_pos, k.to(self.buffer.dtype))
+        self.buffer[1].index_copy_(-2, input_pos, v.to(self.buffer.dtype))
+        return self.buffer[0], self.buffer[1]
+
+    def reset(self):
+        self.length = 0
+
+
 class MultiHeadAttention(nn.Module):
-    """ multiple heads of self-attention in parallel """
+    """
+    multiple heads of self-attention in parallel
+    The heads are computed in one batch with F.scaled_dot_product_attention,
+    which dispatches to the FlashAttention / memory efficient kernels on CUDA.
+    If a residual is passed, it is added to the output.
+    With use_cache or input_pos the keys and values are stored in kv_cache, see allocate_kv_cache.
+    """
 
     def __init__(self, num_heads, head_size, n_embd, block_size, dropout=0.0):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size, n_embd, block_size, dropout) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        self.n_embd = n_embd
+        self.qkv = nn.Linear(n_embd, 3 * n_embd, bias=False)
         self.proj = nn.Linear(n_embd, n_embd)
+        self.dropout_p = dropout
         self.dropout = nn.Dropout(dropout)
-
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+        self.kv_cache = None
+
+    def forward(self, x, residual=None, use_cache=False, input_pos=None):
+        # leading dimensions are kept generic to support unbatched input (T, C)
+        *B, T, C = x.shape
+        q, k, v = self.qkv(x).split(self.n_embd, dim=-1)
+        q = q.view(*B, T, self.num_heads, self.head_size).transpose(-3, -2) # (..., nH, T, hs)
+        k = k.view(*B, T, self.num_heads, self.head_size).transpose(-3, -2)
+        v = v.view(*B, T, self.num_heads, self.head_size).transpose(-3, -2)
+
+        past_length = 0
+        attn_mask = None
+        if use_cache or input_pos is not None:
+            assert self.kv_cache is not None, "the KV cache has to be allocated with allocate_kv_cache"
+        if input_pos is not None:
+            # fixed shapes, so that a compiled step is reused: the whole buffer is attended
+            # to and the positions after input_pos, which are not filled yet, are masked
+            k, v = self.kv_cache.write(k, v, input_pos)
+            attn_mask = torch.arange(k.shape[-2], device=x.device) <= input_pos.view(-1, 1)
+        elif use_cache:
+            past_length = self.kv_cache.length
+            k, v = self.kv_cache.update(k, v)
+            if past_length > 0 and T > 1:
+                # new token t may attend to the cached tokens and to the new tokens up to t
+                attn_mask = torch.ones(T, past_length + T, dtype=torch.bool, device=x.device).tril(diagonal=past_length)
+
+        # is_causal aligns the mask to the upper left, so it is only correct without cached tokens
+        out = F.scaled_dot_product_attention(q, k, v,
+                                             attn_mask=attn_mask,
+                                             dropout_p=self.dropout_p if self.training else 0.0,
+                                             is_causal=attn_mask is None and past_length == 0)
+        out = out.transpose(-3, -2).contiguous().view(*B, T, C)
         out = self.proj(out)
         out = self.dropout(out)
-        return out
+        if residual is None:
+            return out
+        return residual + out
     
 class Block(nn.Module):
     """ Transformer block: communication followed by computation """
@@ -184,8 +336,8 @@ class Block(nn.Module):
         self.ln2 = nn.LayerNorm(n_embd)
 
 
-    def forward(self, x):
-        x = x + self.sa(self.ln1(x))
+    def forward(self, x, use_cache=False, input_pos=None):
+        x = self.sa(self.ln1(x), residual=x, use_cache=use_cache, input_pos=input_pos)
         x = x + self.ffwd(self.ln2(x))
         return x
     
@@ -199,8 +351,8 @@ class BlockGPT1(nn.Module):
         self.ln2 = nn.LayerNorm(n_embd)
 
 
-    def forward(self, x):
-        x = self.multi_head(x) + x
+    def forward(self, x, use_cache=False, input_pos=None):
+        x = self.multi_head(x, residual=x, use_cache=use_cache, input_pos=input_pos)
         x = self.ln1(x)
         x = self.ffwd(x) + x
         x = self.ln2(x)
@@ -217,20 +369,161 @@ class BlockGPT2(nn.Module):
         self.ln2 = LayerNorm(n_embd, bias)
 
 
-    def forward(self, x):
-        x = x + self.multi_head(self.ln1(x)) 
+    def forward(self, x, use_cache=False, input_pos=None):
+        x = self.multi_head(self.ln1(x), residual=x, use_cache=use_cache, input_pos=input_pos)
         x = x + self.ffwd(self.ln2(x)) 
         return x
    
     
-def generate(model, idx, max_new_tokens, block_size=None):
+def compile_supported():
+    """
+    Returns whether torch.compile can be used, the dynamo of torch 2.0 e. g. does not support Python 3.11+.
+    """
+    import torch._dynamo
+    try:
+        torch._dynamo.eval_frame.check_if_dynamo_supported()
+    except RuntimeError:
+        return False
+    return True
+
+
+def quantize_for_cpu(model):
+    """
+    Returns a copy of the model with dynamically int8 quantized nn.Linear layers,
+    which run on the int8 GEMM kernels (FBGEMM on x86) for CPU inference.
+    Embeddings and RNNs are not quantized.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+class Int8Linear(nn.Module):
+    """
+    Weight-only int8 version of a nn.Linear layer. The weight is stored as int8 with
+    one float16 scale per output channel and dequantized to the input dtype in forward,
+    which halves the weight memory compared to float16 and quarters it compared to float32.
+    """
+
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        weight = linear.weight.detach()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer('weight', torch.round(weight / scale[:, None]).to(torch.int8))
+        self.register_buffer('scale', scale.to(torch.float16))
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().clone())
+
+    def forward(self, x):
+        weight = self.weight.to(x.dtype) * self.scale.to(x.dtype)[:, None]
+        return F.linear(x, weight, self.bias)
+
+
+def convert_to_int8(model, layers=("lm_head", "ffwd.net.0", "ffwd.net.2")):
+    """
+    Replaces the nn.Linear modules of the model, whose names end with one of layers,
+    with Int8Linear. By default these are the lm_head and the feed forward layers,
+    the attention projections are kept to preserve accuracy. The model is changed in place.
+    """
+    for name, module in list(model.named_modules()):
+        if isinstance(module, nn.Linear) and any(name == layer or name.endswith("." + layer) for layer in layers):
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, Int8Linear(module))
+    return model
+
+
+def allocate_kv_cache(model, batch_size, max_length):
+    """
+    Allocates the keys and values of all attention layers of the model in one
+    contiguous tensor of shape (n_layer, 2, B, nH, max_length, hs) and attaches
+    a KVCache view to every layer, which is used by forward with use_cache or input_pos.
+    If the model already has caches for batch_size and at least max_length tokens,
+    they are reset and reused, so that a compiled decode step stays valid.
+    Returns the caches and sets them as model.kv_cache.
+    """
+    attention_layers = [module for module in model.modules() if isinstance(module, MultiHeadAttention)]
+    attention = attention_layers[0]
+    # the embedding weights also give the float dtype for models with quantized linear layers
+    weight = next(model.parameters())
+    if attention.kv_cache is not None:
+        buffer = attention.kv_cache.buffer
+        if (buffer.shape[1] == batch_size and buffer.shape[-2] >= max_length
+                and buffer.device == weight.device and buffer.dtype == weight.dtype):
+            for layer_cache in model.kv_cache:
+                layer_cache.reset()
+            return model.kv_cache
+    # zeros instead of empty, the masked positions still take part in the attention matmuls and NaNs would propagate
+    buffer = torch.zeros(len(attention_layers), 2, batch_size, attention.num_heads, max_length, attention.head_size,
+                         device=weight.device, dtype=weight.dtype)
+    model.kv_cache = [KVCache(buffer[layer]) for layer in range(len(attention_layers))]
+    for layer, layer_cache in zip(attention_layers, model.kv_cache):
+        layer.kv_cache = layer_cache
+    return model.kv_cache
+
+
+def _decode_step(model, idx, input_pos):
+    return model(idx, input_pos=input_pos)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_decode_step():
+    # compiled only once, dynamo guards on the model, so a model is compiled
+    # at its first decode step and the compiled step is reused by later generate calls
+    return torch.compile(_decode_step, mode="reduce-overhead", dynamic=False)
+
+
+@torch.no_grad()
+def generate(model, idx, max_new_tokens, block_size=None, quantize=False, compile=False):
+    """
+    Samples max_new_tokens tokens following idx of shape (B, T).
+    For the transformer models the keys and values of the processed tokens are
+    cached, so after the prompt only the last token is fed to the model.
+    If quantize is True and the model is on the CPU, the linear layers are
+    quantized to int8 once before sampling, see quantize_for_cpu.
+    If compile is True, the model is on CUDA and torch.compile is supported, the decode
+    steps are compiled with torch.compile(mode="reduce-overhead"): every step feeds one
+    token at a position given as tensor and attends over the whole preallocated cache,
+    so all steps have the same shapes and the step is only compiled once. This only pays
+    off for long generations, and whether the step is also captured as CUDA graph depends
+    on the torch version, torch 2.0 skips CUDA graphs for the in place cache updates.
+    """
     model.eval()
+    if quantize and next(model.parameters()).device.type == "cpu":
+        model = quantize_for_cpu(model)
+    use_cache = isinstance(model, (simpleGPT, GPT1, GPT2))
+    if use_cache:
+        max_length = idx.shape[1] + max_new_tokens
+        if block_size is not None:
+            max_length = min(max_length, block_size)
+        allocate_kv_cache(model, idx.shape[0], max_length)
+    static_decode = compile and use_cache and idx.device.type == "cuda" and compile_supported()
+    if static_decode:
+        decode_step = _compiled_decode_step()
+    cache_valid = False
+    position = 0
     for _ in range(max_new_tokens):
-        if block_size is None:
-            idx_cond = idx
-        else: 
-            idx_cond = idx[:, -block_size:]
-        logits = model(idx_cond)
+        if block_size is not None and idx.shape[1] > block_size:
+            # positions are absolute, cropping the context shifts them and invalidates the cache
+            cache_valid = False
+        if cache_valid and static_decode:
+            input_pos = torch.tensor([position], device=idx.device)
+            logits = decode_step(model, idx[:, -1:], input_pos)
+            position += 1
+        elif cache_valid:
+            logits = model(idx[:, -1:], use_cache=True)
+        else:
+            if block_size is None:
+                idx_cond = idx
+            else: 
+                idx_cond = idx[:, -block_size:]
+            if use_cache:
+                for layer_cache in model.kv_cache:
+                    layer_cache.reset()
+                # the prompt has a varying length and is processed eagerly
+                logits = model(idx_cond, use_cache=True)
+                cache_valid = True
+                position = idx_cond.shape[1]
+            else:
+                logits = model(idx_cond)
         logits = logits[:, -1, :]
         probs = F.softmax(logits, dim=-1) 
         idx_next = torch.multinomial(probs, num_samples=1) 
@@ -242,23 +535,24 @@ def generate(model, idx, max_new_tokens, block_size=None):
 
 # 4. RNNs
 
-def moveTo(obj, device):
+def moveTo(obj, device, non_blocking=False):
     """
     obj: the python object to move to a device, or to move its contents to a device
     device: the compute device to move objects to
+    non_blocking: copy asynchronously, only has an effect for pinned memory
     """
     if hasattr(obj, "to"):
-        return obj.to(device)
+        return obj.to(device, non_blocking=non_blocking)
     elif isinstance(obj, list):
-        return [moveTo(x, device) for x in obj]
+        return [moveTo(x, device, non_blocking) for x in obj]
     elif isinstance(obj, tuple):
-        return tuple(moveTo(list(obj), device))
+        return tuple(moveTo(list(obj), device, non_blocking))
     elif isinstance(obj, set):
-        return set(moveTo(list(obj), device))
+        return set(moveTo(list(obj), device, non_blocking))
     elif isinstance(obj, dict):
         to_ret = dict()
         for key, value in obj.items():
-            to_ret[moveTo(key, device)] = moveTo(value, device)
+            to_ret[moveTo(key, device, non_blocking)] = moveTo(value, device, non_blocking)
         return to_ret
     else:
         return obj
@@ -292,25 +586,47 @@ class LastTimeStep(nn.Module):
     """
     A class for extracting the hidden activations of the last time step following 
     the output of a PyTorch RNN module. 
+    rnn_type: one of 'rnn', 'gru' or 'lstm', the type of the preceding RNN module,
+        if None it is detected from the output of the first call
     """
-    def __init__(self, rnn_layers=1, bidirectional=False):
+    def __init__(self, rnn_layers=1, bidirectional=False, rnn_type=None):
         super(LastTimeStep, self).__init__()
+        assert rnn_type in (None, 'rnn', 'gru', 'lstm'), f"{rnn_type=} is not supported"
         self.rnn_layers = rnn_layers
         if bidirectional:
-            self.num_driections = 2
+            self.num_directions = 2
         else:
-            self.num_driections = 1    
+            self.num_directions = 1    
+        self.rnn_type = rnn_type
+        #The result is either a tuple (out, h_t) or for LSTMs a tuple (out, (h_t, c_t)),
+        #so the type is only checked in the first call, which chooses the way to get h_t
+        self._extract = self._select_hidden_state
+        self._single_layer = rnn_layers == 1 and not bidirectional
+
+    def _select_hidden_state(self, hidden):
+        is_lstm = isinstance(hidden, tuple)
+        if self.rnn_type is not None and is_lstm != (self.rnn_type == 'lstm'):
+            raise ValueError(f"{self.rnn_type=} does not match the output of the RNN module, "
+                             f"which is {'a tuple (h_t, c_t)' if is_lstm else 'a tensor h_t'}")
+        self._extract = self._hidden_state_lstm if is_lstm else self._hidden_state
+        return self._extract(hidden)
+
+    @staticmethod
+    def _hidden_state(hidden):
+        return hidden
+
+    @staticmethod
+    def _hidden_state_lstm(hidden):
+        return hidden[0]
     
     def forward(self, input):
-        #Result is either a tupe (out, h_t)
-        #or a tuple (out, (h_t, c_t))
-        rnn_output = input[0]
-        last_step = input[1] #this will be h_t
-        if(type(last_step) == tuple):#unless it's a tuple, 
-            last_step = last_step[0]#then h_t is the first item in the tuple
+        last_step = self._extract(input[1]) #this will be h_t
+        if self._single_layer:
+            #shape is (1, batch, hidden_size), so the last layer is already (batch, hidden_size)
+            return last_step[-1]
         batch_size = last_step.shape[1] #per docs, shape is: '(num_layers * num_directions, batch, hidden_size)'
         #reshaping so that everything is separate 
-        last_step = last_step.view(self.rnn_layers, self.num_driections, batch_size, -1)
+        last_step = last_step.view(self.rnn_layers, self.num_directions, batch_size, -1)
         #We want the last layer's results
         last_step = last_step[self.rnn_layers-1] 
         #Re order so batch comes first
@@ -17,7 +17,7 @@ import pandas as pd
 import torch
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
-from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay
+from sklearn.metrics import classification_report, confusion_matrix, precision_recall_fscore_support, ConfusionMatrixDisplay
 from sklearn.dummy import DummyClassifier
 from dataclasses import dataclass
 from . import constants, models
@@ -41,6 +41,15 @@ class TrainingConfig:
     class_names: list = None
     progress_bar: bool = True
     checkpoint_epochs: list[int] = None
+    # compile the model with torch.compile when training on GPU
+    compile: bool = True
+    # autocast dtype on GPU, torch.float16 enables the GradScaler, None disables mixed precision,
+    # "auto" uses bfloat16 if the GPU supports it and float16 otherwise
+    amp_dtype: torch.dtype = "auto"
+    # copy batches asynchronously to the GPU and prefetch the next batch on a side stream,
+    # the copies only overlap with the computation if the loaders return pinned memory, e. g.
+    # DataLoader(..., pin_memory=True, num_workers=N, persistent_workers=True, prefetch_factor=2)
+    prefetch: bool = True
 
     def __post_init__(self):
         if self.optimizer == "SGD": 
@@ -71,6 +80,69 @@ class TrainingConfig:
         else:
             logging.info(f"device {self.device} is not available, using cpu instead")
 
+        if self.amp_dtype == "auto":
+            if torch.device(self.device).type != "cuda":
+                self.amp_dtype = None
+            elif torch.cuda.is_bf16_supported():
+                self.amp_dtype = torch.bfloat16
+            else:
+                # GPUs before Ampere, e. g. T4 or V100, do not support bfloat16
+                self.amp_dtype = torch.float16
+            if self.amp_dtype is not None:
+                logging.info(f"using mixed precision with {self.amp_dtype}")
+
+        # bfloat16 has the range of float32, only float16 needs loss scaling
+        self.grad_scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16 and torch.device(self.device).type == "cuda")
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a data loader and copies the next batch to the GPU on a side stream
+    while the current batch is processed. The copies only overlap with the
+    computation if the data loader returns pinned memory.
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.data_loader)
+        next_batch = self._preload(batches, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            # the memory was allocated on the side stream but is used on the current one
+            _record_stream(batch, torch.cuda.current_stream(self.device))
+            next_batch = self._preload(batches, stream)
+            yield batch
+
+    def _preload(self, batches, stream):
+        try:
+            x, y = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return models.moveTo(x, self.device, non_blocking=True), models.moveTo(y, self.device, non_blocking=True)
+
+
+def _record_stream(obj, stream):
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            _record_stream(item, stream)
+    elif isinstance(obj, dict):
+        # keys and values, like moveTo
+        for key, value in obj.items():
+            _record_stream(key, stream)
+            _record_stream(value, stream)
+
 
 def save_loss(results_pd, results_path):
     sns.lineplot(x="epoch", y="training_loss", data=results_pd, label="Training Loss")
@@ -142,7 +214,7 @@ def save_checkpoint(epoch, config, results, validation_result, x_sample):
     # TODO move name of keys to constants
     torch.save({
     'epoch': epoch,
-    'model_state_dict': config.model.state_dict(),
+    'model_state_dict': config._orig_model.state_dict(),
     'optimizer_state_dict': config.optimizer.state_dict(),
     'results' : results_pd,
     'validation_result': validation_result
@@ -150,7 +222,7 @@ def save_checkpoint(epoch, config, results, validation_result, x_sample):
     logging.info("saved result dict")
 
     try: 
-        torch.onnx.export(config.model, x_sample, os.path.join(save_path, "model.onnx"), input_names=["features"], output_names=["logits"])
+        torch.onnx.export(config._orig_model, x_sample, os.path.join(save_path, "model.onnx"), input_names=["features"], output_names=["logits"])
         logging.info("saved onnx model")
     except:
         logging.warn("saving onnx model failed")      
@@ -177,6 +249,18 @@ def train(config: TrainingConfig):
 
     time_training = 0
     config.model.to(config.device)
+    # the uncompiled module is kept for saving the state dict and onnx export
+    config._orig_model = config.model
+    if torch.device(config.device).type == "cuda":
+        torch.set_float32_matmul_precision("high")
+    if config.compile and torch.device(config.device).type == "cuda":
+        if not models.compile_supported():
+            logging.info("torch.compile is not supported in this environment, the model is not compiled")
+        # dynamo of torch 2.0 fails on the rng state handling of non reentrant checkpointing
+        elif getattr(config.model, "gradient_checkpointing", False):
+            logging.info("gradient checkpointing is enabled, the model is not compiled")
+        else:
+            config.model = torch.compile(config.model, mode="reduce-overhead", fullgraph=False)
     for epoch in tqdm(range(config.epochs), desc="epoch", disable = not config.progress_bar):
         config.model = config.model.train()
         epoch_time, _, x_sample = run_epoch(config, results, epoch, prefix="training")
@@ -221,7 +305,7 @@ def train(config: TrainingConfig):
 
     logging.info(f"finished training, took {(time_training / 60 / 60):.3f} hours")
 
-    size_mb = compute_size(config.model)
+    size_mb = compute_size(config._orig_model)
     logging.info(f"Model size (MB) - {size_mb:.4f}")
 
     time_avg_ms, time_std_ms = time_pipeline(config.model, config.validation_loader)
@@ -240,49 +324,65 @@ def run_epoch(config: TrainingConfig, results: dict, epoch, prefix=""):
         data_loader = config.training_loader
     if prefix == "validation":
         data_loader = config.validation_loader
-    running_loss = []
+    # the loss is accumulated on the device, calling loss.item() every batch would synchronize
+    loss_sum = torch.zeros((), device=config.device)
+    n_batches = 0
     y_true = []
     y_pred = []
+    device_type = torch.device(config.device).type
+    use_amp = device_type != "cpu" and config.amp_dtype is not None
+    if config.prefetch and device_type == "cuda":
+        data_loader = CUDAPrefetcher(data_loader, config.device)
     start = time.time()
     for x, y in tqdm(data_loader, desc="batch", leave=False, disable = not config.progress_bar):      
-        x = models.moveTo(x, config.device)
-        y = models.moveTo(y, config.device)
+        x = models.moveTo(x, config.device, non_blocking=config.prefetch)
+        y = models.moveTo(y, config.device, non_blocking=config.prefetch)
 
-        y_hat = config.model(x) 
-        loss = config.loss_func(y_hat, y)
+        with torch.autocast(device_type=device_type, dtype=config.amp_dtype, enabled=use_amp):
+            y_hat = config.model(x) 
+            loss = config.loss_func(y_hat, y)
 
         if config.model.training:
-            loss.backward()
-            config.optimizer.step()
-            config.optimizer.zero_grad()
+            #setting the gradients to None instead of writing zeros into them
+            config.optimizer.zero_grad(set_to_none=True)
+            config.grad_scaler.scale(loss).backward()
+            config.grad_scaler.step(config.optimizer)
+            config.grad_scaler.update()
 
-        running_loss.append(loss.item())
+        loss_sum += loss.detach()
+        n_batches += 1
 
         if config.classification_metrics and isinstance(y, torch.Tensor):
-            #moving labels & predictions back to CPU for computing / storing predictions
-            labels = y.detach().cpu().numpy()
-            y_hat = y_hat.detach().cpu().numpy()
-            #add to predictions so far
-            y_true.extend(labels.tolist())
-            y_pred.extend(y_hat.tolist())
+            if y_hat.dim() == 2 and y_hat.shape[1] > 1: #We have a classification problem, convert to labels on the device
+                y_hat = y_hat.argmax(dim=1)
+            #Else, we assume we are working on a regression problem
+            #the output is copied, float() returns it unchanged for float32 and
+            #the compiled model overwrites its outputs in the next CUDA graph replay
+            else:
+                y_hat = y_hat.detach().float().clone()
+            #add to predictions so far, they are moved to the CPU once after the epoch
+            y_true.append(y.detach())
+            y_pred.append(y_hat.detach())
         
+    epoch_loss = (loss_sum / n_batches).item()
     end =  time.time()
 
-    y_pred = np.asarray(y_pred)
-    if len(y_pred.shape) == 2 and y_pred.shape[1] > 1: #We have a classification problem, convert to labels
-        y_pred = np.argmax(y_pred, axis=1)
-    #Else, we assume we are working on a regression problem
+    if len(y_pred) > 0:
+        #moving labels & predictions back to CPU for computing / storing predictions
+        y_true = torch.cat(y_true).cpu().numpy()
+        y_pred = torch.cat(y_pred).cpu().numpy()
     
     if config.classification_metrics:
-        report_dict = classification_report(y_true, y_pred, output_dict=True, zero_division=0)
-        macro_dict = report_dict['macro avg']
-        results[prefix + "_accuracy"].append(report_dict['accuracy'])
-        results[prefix + "_macro_recall"].append(macro_dict['recall'])
-        results[prefix + "_macro_precision"].append(macro_dict['precision'])
-        results[prefix + "_macro_f1score"].append(macro_dict['f1-score'])
+        #computing only the macro averages, the full classification report is built after training
+        accuracy = np.mean(y_true == y_pred)
+        macro_precision, macro_recall, macro_f1score, _ = precision_recall_fscore_support(y_true, y_pred, average='macro', zero_division=0)
+        results[prefix + "_accuracy"].append(accuracy)
+        results[prefix + "_macro_recall"].append(macro_recall)
+        results[prefix + "_macro_precision"].append(macro_precision)
+        results[prefix + "_macro_f1score"].append(macro_f1score)
 
 
-    results[prefix + "_loss"].append(np.mean(running_loss))
+    results[prefix + "_loss"].append(epoch_loss)
     time_elapsed = end-start
     if not config.progress_bar:
         if prefix == "training":
@@ -300,11 +400,11 @@ def cross_entropy_language_model(logits, targets):
     """
     Removes the time dimension for logits and targets and computes the cross entropy loss
     For the F.cross_entropy function, the inputs are predicted unnormalized logits and output are ground truth class indices or class probabilities
+    Targets with the value -100 are ignored, so padded positions can be marked with it by the data loader.
     """
-    B, T, C = logits.shape
-    logits = logits.view(B*T, C)
-    targets = targets.view(B*T)
-    loss = F.cross_entropy(logits, targets)
+    logits = logits.reshape(-1, logits.size(-1))
+    targets = targets.reshape(-1)
+    loss = F.cross_entropy(logits, targets, ignore_index=-100, reduction='mean')
     return loss
 
 
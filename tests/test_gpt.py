@@ -2,12 +2,14 @@
 import unittest
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 
 import os
 import sys
+import math
 
 sys.path.insert(0, os.getcwd())
-from dl.models import Config, GPT1
+from dl.models import Config, GPT1, GPT2, allocate_kv_cache, compile_supported, generate
 
 
 class TestGPT(unittest.TestCase):
@@ -97,6 +99,101 @@ class TestGPT(unittest.TestCase):
         logits = model(x)
         self.assertTrue(logits.shape == (1, self.config.vocab_size))
 
+    def test_weight_tying(self):
+        model = GPT1(self.config)
+
+        self.assertTrue(model.lm_head.weight is model.token_embedding_table.weight)
+        # the shared weight is stored under both names in the state dict, but is only one parameter
+        self.assertTrue(len(list(model.parameters())) == len(model.state_dict()) - 1)
+
+    def test_initial_loss(self):
+        torch.manual_seed(0)
+        config = Config(vocab_size=1000, dim_embeddings=64, dim_context=8, num_heads=4, n_layer=2, dropout=0.0)
+        x = torch.randint(config.vocab_size, (4, config.dim_context))
+        y = torch.randint(config.vocab_size, (4, config.dim_context))
+
+        for model_class in (GPT1, GPT2):
+            model = model_class(config).eval()
+            with torch.no_grad():
+                logits = model(x)
+            loss = F.cross_entropy(logits.reshape(-1, config.vocab_size), y.reshape(-1))
+            # with the small init of the tied weight the initial predictions are close to uniform
+            self.assertTrue(abs(loss.item() - math.log(config.vocab_size)) < 0.5)
+            for embedding in (model.token_embedding_table, model.position_embedding_table):
+                self.assertTrue(abs(embedding.weight.std().item() - 0.02) < 0.005)
+
+    def test_gradient_checkpointing(self):
+        x = torch.tensor([[1, 4, 2, 7, 3]])
+        config = Config(vocab_size=26, dim_embeddings=3, dim_context=5, num_heads=3, n_layer=2, dropout=0.0)
+        model = GPT1(config)
+        model_checkpointed = GPT1(Config(**{**config.__dict__, "gradient_checkpointing": True}))
+        model_checkpointed.load_state_dict(model.state_dict())
+
+        model(x).sum().backward()
+        model_checkpointed(x).sum().backward()
+
+        for p, p_checkpointed in zip(model.parameters(), model_checkpointed.parameters()):
+            self.assertTrue(torch.allclose(p.grad, p_checkpointed.grad, atol=1e-6))
+
+    def test_kv_cache(self):
+        x = torch.tensor([[1, 4, 2, 7, 3]])
+        model = GPT1(self.config).eval()
+
+        with torch.no_grad():
+            logits_expected = model(x)
+
+            kv_cache = allocate_kv_cache(model, batch_size=1, max_length=5)
+            logits_prompt = model(x[:, :2], use_cache=True)
+            logits_chunk = model(x[:, 2:4], use_cache=True)
+            logits_token = model(x[:, 4:], use_cache=True)
+
+        logits = torch.cat([logits_prompt, logits_chunk, logits_token], dim=1)
+        self.assertTrue(kv_cache[0].length == 5)
+        self.assertTrue(torch.allclose(logits, logits_expected, atol=1e-6))
+
+    def test_kv_cache_fixed_shapes(self):
+        x = torch.tensor([[1, 4, 2, 7, 3]])
+        model = GPT1(self.config).eval()
+
+        with torch.no_grad():
+            logits_expected = model(x)
+
+            allocate_kv_cache(model, batch_size=1, max_length=5)
+            logits = [model(x[:, :2], use_cache=True)]
+            for position in range(2, 5):
+                input_pos = torch.tensor([position])
+                logits.append(model(x[:, position:position+1], input_pos=input_pos))
+
+        logits = torch.cat(logits, dim=1)
+        self.assertTrue(torch.allclose(logits, logits_expected, atol=1e-6))
+
+    @unittest.skipIf(not compile_supported(), "torch.compile is not supported in this environment")
+    def test_kv_cache_compiled(self):
+        x = torch.tensor([[1, 4, 2, 7, 3]])
+        model = GPT1(self.config).eval()
+        # aot_eager traces the step like inductor does, but runs on the CPU
+        decode_step = torch.compile(model, backend="aot_eager", dynamic=False)
+
+        with torch.no_grad():
+            logits_expected = model(x)
+
+            allocate_kv_cache(model, batch_size=1, max_length=5)
+            logits = [model(x[:, :2], use_cache=True)]
+            for position in range(2, 5):
+                input_pos = torch.tensor([position])
+                logits.append(decode_step(x[:, position:position+1], input_pos=input_pos))
+
+        logits = torch.cat(logits, dim=1)
+        self.assertTrue(torch.allclose(logits, logits_expected, atol=1e-6))
+
+    def test_generate_quantized(self):
+        idx = torch.zeros((1, 1), dtype=torch.long)
+        model = GPT1(self.config)
+
+        idx_generated = generate(model, idx, max_new_tokens=3, block_size=self.config.dim_context, quantize=True)
+
+        self.assertTrue(idx_generated.shape == (1, 4))
+
 
 if __name__ == "__main__":
     unittest.main() 
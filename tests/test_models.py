@@ -39,6 +39,23 @@ class TestSanityChecks(unittest.TestCase):
         self.assertTrue(output.shape == (B, T, H))
         self.assertTrue(h_n.shape == (1, B, H))
 
+    def test_last_time_step_lstm(self):
+        B, T, D = 2, 5, 2
+        H = 3
+        x = torch.rand([B, T, D])
+
+        for num_layers in (1, 2):
+            lstm = nn.LSTM(D, H, num_layers=num_layers, batch_first=True)
+            output, (h_n, c_n) = lstm(x)
+
+            last_step = LastTimeStep(rnn_layers=num_layers)((output, (h_n, c_n)))
+
+            self.assertTrue(last_step.shape == (B, H))
+            self.assertTrue(torch.equal(last_step, h_n[-1]))
+
+        with self.assertRaises(ValueError):
+            LastTimeStep(rnn_type='rnn')((output, (h_n, c_n)))
+
 
 
 
@@ -177,6 +194,46 @@ class TestBigramLanguageModel(unittest.TestCase):
 
         self.assertTrue(out.shape == (B, block_size, num_heads * head_size))
 
+    def test_self_attention_multi_head_fused_qkv(self):
+        B = 2
+        n_embd = 8
+        block_size = 5 # This is T
+        head_size = 2
+        num_heads = 4
+        x = torch.rand((B, block_size, n_embd))
+
+        multi_head = MultiHeadAttention(num_heads, head_size, n_embd, block_size).eval()
+        heads = [Head(head_size, n_embd, block_size).eval() for _ in range(num_heads)]
+        with torch.no_grad():
+            # the fused projection holds the weights of all heads: [q_0..q_h, k_0..k_h, v_0..v_h]
+            weight_q, weight_k, weight_v = multi_head.qkv.weight.split(n_embd)
+            for i, head in enumerate(heads):
+                rows = slice(i * head_size, (i + 1) * head_size)
+                head.query.weight.copy_(weight_q[rows])
+                head.key.weight.copy_(weight_k[rows])
+                head.value.weight.copy_(weight_v[rows])
+
+            out_expected = multi_head.proj(torch.cat([head(x) for head in heads], dim=-1))
+            out = multi_head(x)
+
+        self.assertTrue(torch.allclose(out, out_expected, atol=1e-6))
+
+    def test_self_attention_multi_head_residual(self):
+        B = 2
+        n_embd = 8
+        block_size = 5 # This is T
+        head_size = 2
+        num_heads = 4
+        x = torch.rand((B, block_size, n_embd))
+
+        head = MultiHeadAttention(num_heads, head_size, n_embd, block_size).eval()
+        with torch.no_grad():
+            out_expected = x + head(x)
+            out = head(x, residual=x)
+
+        self.assertTrue(out.shape == (B, block_size, n_embd))
+        self.assertTrue(torch.allclose(out, out_expected, atol=1e-6))
+
     def test_embedding_self_attention(self):
         x = torch.tensor([[1, 2, 3, 4, 5],
                         [4, 23, 1, 0, 25],
@@ -278,6 +335,30 @@ class TestBigramLanguageModel(unittest.TestCase):
                                                          [3.0, 9.0, 0.0],
                                                          [5.0, 7.0, 0.0]]])))
             
+    def test_int8_linear(self):
+        layer = nn.Linear(8, 4)
+        x = torch.rand((3, 8))
+
+        layer_int8 = Int8Linear(layer)
+        with torch.no_grad():
+            y_expected = layer(x)
+            y = layer_int8(x)
+
+        self.assertTrue(layer_int8.weight.dtype == torch.int8)
+        self.assertTrue(y.shape == (3, 4))
+        self.assertTrue(torch.allclose(y, y_expected, atol=5e-2))
+
+    def test_convert_to_int8(self):
+        config = Config(vocab_size=26, dim_embeddings=8, dim_context=5, num_heads=2, n_layer=2, dropout=0.0)
+        model = convert_to_int8(GPT2(config))
+        x = torch.tensor([[1, 2, 3]])
+
+        self.assertTrue(isinstance(model.lm_head, Int8Linear))
+        self.assertTrue(isinstance(model.blocks[1].ffwd.net[0], Int8Linear))
+        self.assertTrue(isinstance(model.blocks[1].ffwd.net[2], Int8Linear))
+        self.assertTrue(isinstance(model.blocks[1].multi_head.qkv, nn.Linear))
+        self.assertTrue(model(x).shape == (1, 3, config.vocab_size))
+
     def test_serialize_model(self):
         from sklearn.datasets import make_moons
 